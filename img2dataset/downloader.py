@@ -1,10 +1,20 @@
 """the downloader module handles the downloading"""
 
 from multiprocessing.pool import ThreadPool
-from threading import Semaphore
-import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Set
+from threading import Condition, Thread
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+import errno
+import functools
 import io
 import math
+import os
+import re
+import socket
+import urllib.request
 import exifread
 import json
 import time
@@ -13,24 +23,29 @@ import pyarrow as pa
 import traceback
 
 import fsspec
+from fsspec.implementations.local import LocalFileSystem
+import urllib3
+import urllib3.connection
+import urllib3.exceptions
+import urllib3.util.connection
 from .logger import CappedCounter
 from .logger import write_stats
 
 
+# optional "user agent token:" prefix, then the comma separated directives
+X_ROBOTS_TAG_RE = re.compile(r"(?:([^:]*):)?(.*)", re.DOTALL)
+
+
 def is_disallowed(headers, user_agent_token, disallowed_header_directives):
     """Check if HTTP headers contain an X-Robots-Tag directive disallowing usage"""
-    for values in headers.get_all("X-Robots-Tag", []):
-        try:
-            uatoken_directives = values.split(":", 1)
-            directives = [x.strip().lower() for x in uatoken_directives[-1].split(",")]
-            ua_token = uatoken_directives[0].lower() if len(uatoken_directives) == 2 else None
-            if (ua_token is None or ua_token == user_agent_token) and any(
-                x in disallowed_header_directives for x in directives
-            ):
-                return True
-        except Exception as err:  # pylint: disable=broad-except
-            traceback.print_exc()
-            print(f"Failed to parse X-Robots-Tag: {values}: {err}")
+    for values in headers.getlist("X-Robots-Tag"):
+        match = X_ROBOTS_TAG_RE.fullmatch(values.lower())
+        assert match is not None  # the pattern matches any string
+        ua_token, directives = match.groups()
+        if ua_token is not None and ua_token.strip() != user_agent_token:
+            continue
+        if not disallowed_header_directives.isdisjoint(x.strip() for x in directives.split(",")):
+            return True
     return False
 
 
@@ -38,101 +53,436 @@ def is_rate_limit_error(err):
     return 'HTTP Error 429' in err
 
 
-def download_image(row, timeout, user_agent_token, disallowed_header_directives):
-    """Download an image with urllib"""
-    key, url = row
-    img_stream = None
+def is_timeout_error(err):
+    return "timed out" in err
+
+
+class ResizableSemaphore:
+    """A semaphore whose number of slots can be changed while it is in use"""
+
+    def __init__(self, value):
+        self._cond = Condition()
+        self._value_max = value
+        self._in_use = 0
+
+    @property
+    def value_max(self):
+        return self._value_max
+
+    def acquire(self):
+        with self._cond:
+            while self._in_use >= self._value_max:
+                self._cond.wait()
+            self._in_use += 1
+        return True
+
+    def release(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def resize(self, value):
+        with self._cond:
+            self._value_max = value
+            self._cond.notify_all()
+
+
+class ConcurrencyController:
+    """Hill climb the number of in flight samples of a shard
+
+    Every window completions, the throughput is compared with the previous window:
+    the capacity keeps moving in the same direction while it improves, turns around when it degrades
+    and is halved when too many requests were rate limited or when the timeouts burst.
+    Timeouts alone don't mean the hosts are congested, dead hosts time out at a steady rate,
+    so only a timeout rate rising above the one of the previous window counts as throttling.
+    """
+
+    def __init__(self, semaphore, min_value, max_value, window=256, step=None, throttle_threshold=0.05):
+        self.semaphore = semaphore
+        self.min_value = min_value
+        self.max_value = max_value
+        self.window = window
+        self.step = step if step is not None else max(1, min_value // 4)
+        self.throttle_threshold = throttle_threshold
+        self.direction = 1
+        self.last_throughput = None
+        self.last_timeout_rate = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self.completed = 0
+        self.rate_limited = 0
+        self.timed_out = 0
+        self.window_start = time.perf_counter()
+
+    def record(self, error_message):
+        """Record one completed sample and adjust the capacity at the end of a window"""
+        self.completed += 1
+        if error_message is not None:
+            if is_rate_limit_error(error_message):
+                self.rate_limited += 1
+            elif is_timeout_error(error_message):
+                self.timed_out += 1
+        if self.completed >= self.window:
+            self._adjust()
+
+    def _adjust(self):
+        """Move the capacity at the end of a window"""
+        throughput = self.completed / max(time.perf_counter() - self.window_start, 1e-6)
+        timeout_rate = self.timed_out / self.completed
+        timeout_burst = (
+            self.last_timeout_rate is not None and timeout_rate > self.last_timeout_rate + self.throttle_threshold
+        )
+        value = self.semaphore.value_max
+        if self.rate_limited > self.throttle_threshold * self.completed or timeout_burst:
+            self.direction = 1
+            value = value // 2
+        else:
+            if self.last_throughput is not None and throughput < self.last_throughput:
+                self.direction = -self.direction
+            value += self.direction * self.step
+        self.semaphore.resize(min(self.max_value, max(self.min_value, value)))
+        self.last_throughput = throughput
+        self.last_timeout_rate = timeout_rate
+        self._reset_window()
+
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+# name -> hasher constructor of the always available hashes
+HASH_CONSTRUCTORS: Dict[str, Callable] = {"md5": hashlib.md5, "sha256": hashlib.sha256, "sha512": hashlib.sha512}
+
+
+def get_hash_constructor(hash_type):
+    """Resolve a hasher constructor, blake3 and xxh3_128 are fast non cryptographic options for dedup keys"""
+    if hash_type in HASH_CONSTRUCTORS:
+        return HASH_CONSTRUCTORS[hash_type]
+    if hash_type == "blake3":
+        try:
+            import blake3  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise ModuleNotFoundError("blake3 hashes require blake3 to be installed. Run `pip install blake3`.") from e
+        return blake3.blake3
+    if hash_type == "xxh3_128":
+        try:
+            import xxhash  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise ModuleNotFoundError(
+                "xxh3_128 hashes require xxhash to be installed. Run `pip install xxhash`."
+            ) from e
+        return xxhash.xxh3_128
+    return getattr(hashlib, hash_type)
+
+
+def compute_hashes(data, hash_constructors):
+    """Compute the digests of data for all the hash constructors in a single pass over the data"""
+    hashers = {hash_type: constructor() for hash_type, constructor in hash_constructors.items()}
+    view = memoryview(data)
+    for i in range(0, len(view), HASH_CHUNK_SIZE):
+        # update all the hashers while the chunk is still hot in cache
+        chunk = view[i : i + HASH_CHUNK_SIZE]
+        for hasher in hashers.values():
+            hasher.update(chunk)
+    return {hash_type: hasher.digest() for hash_type, hasher in hashers.items()}
+
+
+def decode_hex_digest(hex_digest):
+    try:
+        return bytes.fromhex(hex_digest)
+    except (TypeError, ValueError):
+        return None
+
+
+DNS_CACHE_MAX_SIZE = 10**5
+# host -> resolved ip address, shared by the shards downloaded in this process
+dns_cache: Dict[str, str] = {}
+
+
+def resolve_host(host):
+    try:
+        addresses = socket.getaddrinfo(host, None, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+        return host, addresses[0][4][0]
+    except Exception:  # pylint: disable=broad-except
+        return host, None
+
+
+def prewarm_dns(urls, thread_count=64):
+    """Resolve concurrently the hosts of a shard that are not yet in the dns cache"""
+    hosts = set()
+    for url in urls:
+        try:
+            host = urlparse(url).hostname
+        except Exception:  # pylint: disable=broad-except
+            continue
+        if host is not None and host not in dns_cache:
+            hosts.add(host)
+    if not hosts:
+        return
+    if len(dns_cache) + len(hosts) > DNS_CACHE_MAX_SIZE:
+        dns_cache.clear()
+    with ThreadPool(min(thread_count, len(hosts))) as pool:
+        for host, address in pool.imap_unordered(resolve_host, hosts):
+            if address is not None:
+                dns_cache[host] = address
+
+
+def is_unreachable_address_error(err):
+    """Tell if a connection failed in a way that connecting to another address of the host may avoid"""
+    cause = err.__cause__ or err.__context__
+    return isinstance(cause, ConnectionRefusedError) or (
+        isinstance(cause, OSError) and cause.errno in (errno.ENETUNREACH, errno.EHOSTUNREACH)
+    )
+
+
+class DnsCacheConnectionMixin:
+    """urllib3 connection which connects to the address cached for its host by prewarm_dns when there is one"""
+
+    def _new_conn(self):
+        """Connect to the cached address, falling back to the regular resolution when it is unreachable"""
+        host = self._dns_host
+        cached_address = dns_cache.get(host)
+        if cached_address is None:
+            return super()._new_conn()
+        # the host header and the tls server name derive from _dns_host, so it is only swapped while connecting
+        self._dns_host = cached_address
+        try:
+            return super()._new_conn()
+        except urllib3.exceptions.NewConnectionError as err:
+            # timeouts are raised as they are, connecting again would double the wait on a dead host
+            if not is_unreachable_address_error(err):
+                raise
+            # the cached address may be stale, let the regular resolution happen
+            dns_cache.pop(host, None)
+        finally:
+            self._dns_host = host
+        return super()._new_conn()
+
+
+class DnsCacheHTTPConnection(DnsCacheConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class DnsCacheHTTPSConnection(DnsCacheConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class DnsCacheHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = DnsCacheHTTPConnection
+
+
+class DnsCacheHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = DnsCacheHTTPSConnection
+
+
+# retries are handled by download_image_with_retry, only let urllib3 follow redirects
+HTTP_RETRIES = urllib3.Retry(total=None, connect=0, read=0, redirect=10, status=0, other=0)
+
+
+def get_user_agent_string(user_agent_token):
     user_agent_string = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36"
     if user_agent_token:
         user_agent_string += f" (compatible; {user_agent_token}; +https://github.com/rom1504/img2dataset)"
+    return user_agent_string
+
+
+# certificates are not verified, like urllib did with the unverified default context set in main, so don't warn
+# about it on every request
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+class ProxyAwarePoolManager:
+    """urllib3 pools going through the proxies of the environment (http_proxy, https_proxy, no_proxy) like urllib"""
+
+    def __init__(self, **pool_kwargs):
+        pool_kwargs.setdefault("cert_reqs", "CERT_NONE")
+        self.direct = urllib3.PoolManager(**pool_kwargs)
+        # only the direct connections use the dns cache, the proxies resolve the hosts themselves
+        self.direct.pool_classes_by_scheme = {"http": DnsCacheHTTPConnectionPool, "https": DnsCacheHTTPSConnectionPool}
+        self.proxies = {}
+        for scheme, proxy_url in urllib.request.getproxies().items():
+            if scheme not in ("http", "https"):
+                continue
+            if "://" not in proxy_url:
+                proxy_url = "http://" + proxy_url
+            self.proxies[scheme] = urllib3.ProxyManager(proxy_url, **pool_kwargs)
+
+    def request(self, method, url, **kwargs):
+        if self.proxies:
+            parsed_url = urlparse(url)
+            proxy = self.proxies.get(parsed_url.scheme)
+            if proxy is not None and not urllib.request.proxy_bypass(parsed_url.hostname or ""):
+                return proxy.request(method, url, **kwargs)
+        return self.direct.request(method, url, **kwargs)
+
+    def clear(self):
+        self.direct.clear()
+        for proxy in self.proxies.values():
+            proxy.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.clear()
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header value, a number of seconds or an http date, into seconds"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        request = urllib.request.Request(url, data=None, headers={"User-Agent": user_agent_string})
-        with urllib.request.urlopen(request, timeout=timeout) as r:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def download_image(row, timeout, user_agent_token, disallowed_header_directives, http_pool):
+    """Download an image with a pooled urllib3 client, returns (key, img_bytes, err, http status, retry after)"""
+    key, url = row
+    img_bytes = None
+    status = None
+    try:
+        r = http_pool.request("GET", url, timeout=timeout, retries=HTTP_RETRIES, preload_content=False)
+        status = r.status
+        try:
+            if r.status == 429:
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+                return key, None, f"HTTP Error {r.status}: {r.reason}", status, retry_after
+            if r.status >= 400:
+                return key, None, f"HTTP Error {r.status}: {r.reason}", status, None
             if disallowed_header_directives and is_disallowed(
                 r.headers,
                 user_agent_token,
                 disallowed_header_directives,
             ):
-                import remote_pdb; remote_pdb.set_trace()
-                return key, None, "Use of image disallowed by X-Robots-Tag directive"
-            img_stream = io.BytesIO(r.read())
-        return key, img_stream, None
+                return key, None, "Use of image disallowed by X-Robots-Tag directive", status, None
+            img_bytes = r.read()
+        finally:
+            if img_bytes is None:
+                # the body was not consumed, so the connection can't go back to the pool
+                r.close()
+            r.release_conn()
+        return key, img_bytes, None, status, None
     except Exception as err:  # pylint: disable=broad-except
-        # import remote_pdb; remote_pdb.set_trace()
-        #if not is_rate_limit_error(err):
-        #    print(f"error: {url}: {err}")
-        if img_stream is not None:
-            img_stream.close()
-        return key, None, str(err)
+        return key, None, str(err), status, None
 
 
-def download_image_with_retry(row, timeout, retries, user_agent_token, disallowed_header_directives):
+def download_image_with_retry(row, timeout, retries, user_agent_token, disallowed_header_directives, http_pool):
+    """Download an image, retrying on errors and waiting between retries when rate limited"""
+    # the wait honors the Retry-After header if there is one, otherwise it doubles from 2 * timeout
+    # the total waiting time of a sample is capped so a rate limiting host can't stall a thread for minutes
     exponential_backoff = 2
-    for _ in range(retries + 1):
-        key, img_stream, err = download_image(row, timeout, user_agent_token, disallowed_header_directives)
-        if err is not None and is_rate_limit_error(err):
-            time.sleep(exponential_backoff * timeout)
-            # print(f"retrying {row[1]}")
+    total_wait = 0
+    max_total_wait = retries * timeout * 4
+    for attempt in range(retries + 1):
+        key, img_bytes, err, status, retry_after = download_image(
+            row, timeout, user_agent_token, disallowed_header_directives, http_pool
+        )
+        if img_bytes is not None:
+            return key, img_bytes, err
+        if status == 429 and attempt < retries:
+            wait = retry_after if retry_after is not None else exponential_backoff * timeout
+            if total_wait + wait > max_total_wait:
+                break
+            time.sleep(wait)
+            total_wait += wait
             exponential_backoff *= 2
-            continue
-        if img_stream is not None:
-            return key, img_stream, err
     return key, None, err
 
 
-def download_and_process_image_with_retry(
-    row,
-    timeout,
-    retries,
-    user_agent_token,
-    disallowed_header_directives,
-    shard_id,
-    shard_to_dl,
-    oom_sample_per_shard,
-    oom_shard_count,
-    column_list,
-    bbox_indice,
-    caption_indice,
-    crop_indice,
-    hash_indice,
-    extract_exif,
-    compute_hash,
-    verify_hash_type,
-    semaphore,
-    resizer,
-):
+@dataclass(frozen=True)
+class WorkerConfig:
+    """Everything a download thread needs to process the samples of a shard, built once per shard"""
+
+    timeout: Any
+    retries: int
+    user_agent_token: Optional[str]
+    disallowed_header_directives: Optional[Set[str]]
+    shard_columns: List[list]
+    # the key of a sample is key_offset + its index in the shard, zero padded to key_width digits
+    key_offset: int
+    key_width: int
+    # columns saved in the metadata, the column containing the verification hash is skipped
+    meta_columns: List[str]
+    meta_indices: List[int]
+    bbox_indice: Optional[int]
+    caption_indice: Optional[int]
+    crop_indice: Optional[int]
+    hash_indice: Optional[int]
+    extract_exif: bool
+    compute_hash: Optional[str]
+    verify_hash_type: Optional[str]
+    # hash type -> hasher constructor, resolved once per shard
+    hash_constructors: Dict[str, Callable]
+    semaphore: ResizableSemaphore
+    resizer: Any
+    http_pool: ProxyAwarePoolManager
+
+
+def download_and_hash_image(row, cfg):
+    """Network stage of a sample, runs in the download threads"""
+    try:
+        key, img_bytes, error_message = download_image_with_retry(
+            row,
+            cfg.timeout,
+            cfg.retries,
+            cfg.user_agent_token,
+            cfg.disallowed_header_directives,
+            cfg.http_pool,
+        )
+        hashes = {}
+        if img_bytes is not None and cfg.hash_constructors:
+            hashes = compute_hashes(img_bytes, cfg.hash_constructors)
+        return key, img_bytes, hashes, error_message
+    except Exception as err:  # pylint: disable=broad-except
+        # the processing stage releases the semaphore and counts the error
+        return row[0], None, {}, f"failed to process sample: {err}"
+
+
+def get_processing_thread_count(processes_count):
+    """Share the cores available to this process between the processes downloading on the machine"""
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+    return max(1, cpu_count // processes_count)
+
+
+def process_image(downloaded, cfg):
+    """CPU stage of a sample (resizing, exif, metadata), runs in the processing threads"""
+    key, img_bytes, hashes, error_message = downloaded
     sample = None
     successes = 0
     failed_to_download = 0
     failed_to_resize = 0
-    key, img_stream, error_message = download_image_with_retry(
-        row, timeout, retries, user_agent_token, disallowed_header_directives
-    )
     try:
-        _, sample_data = shard_to_dl[key]
-        str_key = compute_key(key, shard_id, oom_sample_per_shard, oom_shard_count)
-        meta = {
-            # Skip columsn containing a the verification hash and only save the compute hash
-            **{
-                column_list[i]: sample_data[i]
-                for i in range(len(column_list))
-                if (hash_indice is None or i != hash_indice)
-            },
-            "key": str_key,
-            "status": None,
-            "error_message": error_message,
-            "width": None,
-            "height": None,
-            "original_width": None,
-            "original_height": None,
-        }
-        if extract_exif:
+        sample_data = tuple(column[key] for column in cfg.shard_columns)
+        str_key = f"{cfg.key_offset + key:0{cfg.key_width}d}"
+        caption = sample_data[cfg.caption_indice] if cfg.caption_indice is not None else None
+        meta = dict(zip(cfg.meta_columns, [sample_data[i] for i in cfg.meta_indices]))
+        meta.update(
+            {
+                "key": str_key,
+                "status": None,
+                "error_message": error_message,
+                "width": None,
+                "height": None,
+                "original_width": None,
+                "original_height": None,
+            }
+        )
+        if cfg.extract_exif:
             meta["exif"] = None
 
-        if compute_hash is not None:
-            meta[compute_hash] = None
+        if cfg.compute_hash is not None:
+            meta[cfg.compute_hash] = None
 
-        maybe_crop = sample_data[crop_indice] if crop_indice is not None else None
+        maybe_crop = sample_data[cfg.crop_indice] if cfg.crop_indice is not None else None
 
         if error_message is not None:
             failed_to_download += 1
@@ -142,18 +492,15 @@ def download_and_process_image_with_retry(
             sample = (
                 None,
                 str_key,
-                sample_data[caption_indice] if caption_indice is not None else None,
+                caption,
                 meta,
             )
-            semaphore.release()
+            cfg.semaphore.release()
             return sample, error_message, successes, failed_to_download, failed_to_resize
 
-        if hash_indice is not None:
-            img_stream.seek(0)
-            test_hash = getattr(hashlib, verify_hash_type)(
-                img_stream.read()
-            ).hexdigest()
-            if test_hash != sample_data[hash_indice]:
+        if cfg.hash_indice is not None:
+            # the expected digests were decoded from hex once per shard
+            if hashes[cfg.verify_hash_type] != sample_data[cfg.hash_indice]:
                 failed_to_download += 1
                 status = "failed_to_download"
                 error_message = "hash mismatch"
@@ -162,16 +509,13 @@ def download_and_process_image_with_retry(
                 sample = (
                     None,
                     str_key,
-                    sample_data[caption_indice] if caption_indice is not None else None,
+                    caption,
                     meta,
                 )
-                img_stream.close()
-                del img_stream
-                semaphore.release()
+                cfg.semaphore.release()
                 return sample, error_message, successes, failed_to_download, failed_to_resize
 
-        img_stream.seek(0)
-        bbox_list = sample_data[bbox_indice] if bbox_indice is not None else None
+        bbox_list = sample_data[cfg.bbox_indice] if cfg.bbox_indice is not None else None
         (
             img,
             width,
@@ -179,7 +523,7 @@ def download_and_process_image_with_retry(
             original_width,
             original_height,
             error_message,
-        ) = resizer(img_stream, bbox_list, maybe_crop)
+        ) = cfg.resizer(io.BytesIO(img_bytes), bbox_list, maybe_crop)
         if error_message is not None:
             failed_to_resize += 1
             status = "failed_to_resize"
@@ -188,25 +532,20 @@ def download_and_process_image_with_retry(
             sample = (
                 None,
                 str_key,
-                sample_data[caption_indice] if caption_indice is not None else None,
+                caption,
                 meta,
             )
-            img_stream.close()
-            del img_stream
-            semaphore.release()
+            cfg.semaphore.release()
             return sample, error_message, successes, failed_to_download, failed_to_resize
         successes += 1
         status = "success"
 
-        if extract_exif:
+        if cfg.extract_exif:
             try:
-                img_stream.seek(0)
                 exif = json.dumps(
                     {
                         k: str(v).strip()
-                        for k, v in exifread.process_file(
-                            img_stream, details=False
-                        ).items()
+                        for k, v in exifread.process_file(io.BytesIO(img_bytes), details=False).items()
                         if v is not None
                     }
                 )
@@ -214,41 +553,47 @@ def download_and_process_image_with_retry(
                 exif = None
             meta["exif"] = exif
 
-        if compute_hash is not None:
-            img_stream.seek(0)
-            meta[compute_hash] = getattr(hashlib, compute_hash)(
-                img_stream.read()
-            ).hexdigest()
+        if cfg.compute_hash is not None:
+            meta[cfg.compute_hash] = hashes[cfg.compute_hash].hex()
 
         meta["status"] = status
         meta["width"] = width
         meta["height"] = height
         meta["original_width"] = original_width
         meta["original_height"] = original_height
-        img_stream.close()
-        del img_stream
 
         sample = (
             img,
             str_key,
-            sample_data[caption_indice] if caption_indice is not None else None,
+            caption,
             meta,
         )
     except Exception as err:  # pylint: disable=broad-except
-        traceback.print_exc()
-        print(f"Sample {key} failed to download: {err}")
-    semaphore.release()
+        # counted in the shard status instead of printed, printing from the download threads serializes them
+        sample = None
+        error_message = f"failed to process sample: {err}"
+    cfg.semaphore.release()
 
     return sample, error_message, successes, failed_to_download, failed_to_resize
 
 
-def compute_key(key, shard_id, oom_sample_per_shard, oom_shard_count):
-    true_key = (10**oom_sample_per_shard) * shard_id + key
-    key_format = oom_sample_per_shard + oom_shard_count
-    str_key = "{true_key:0{key_format}d}".format(  # pylint: disable=consider-using-f-string
-        key_format=key_format, true_key=true_key
-    )
-    return str_key
+# removes the downloaded shard files off the critical path, the removal of a shard is waited for when the next one
+# ends so at most one is pending, main then removes the files of the worker processes which got terminated
+shard_removal_executor = ThreadPoolExecutor(max_workers=1)
+pending_shard_removals: List[Future] = []
+
+
+def wait_for_shard_removals():
+    """Wait for the pending removals of the shard files downloaded by this process"""
+    while pending_shard_removals:
+        pending_shard_removals.pop().result()
+
+
+def remove_shard_file(fs, shard_path):
+    try:
+        fs.rm(shard_path)
+    except Exception as err:  # pylint: disable=broad-except
+        print(f"failed to remove shard file {shard_path}: {err}")
 
 
 class Downloader:
@@ -273,6 +618,7 @@ class Downloader:
         user_agent_token,
         disallowed_header_directives,
         blurring_bbox_col=None,
+        processes_count=1,
     ) -> None:
         self.sample_writer_class = sample_writer_class
         self.resizer = resizer
@@ -292,9 +638,10 @@ class Downloader:
         self.disallowed_header_directives = (
             None
             if disallowed_header_directives is None
-            else {directive.strip().lower() for directive in disallowed_header_directives}
+            else frozenset(directive.strip().lower() for directive in disallowed_header_directives)
         )
         self.blurring_bbox_col = blurring_bbox_col
+        self.processes_count = processes_count
 
     def __call__(
         self,
@@ -318,8 +665,13 @@ class Downloader:
         start_time = time.time()
 
         fs, shard_path = fsspec.core.url_to_fs(shard_file)
-        with fs.open(shard_path, "rb") as f:
-            df = pa.ipc.open_file(f).read_all()
+        if isinstance(fs, LocalFileSystem):
+            # zero copy, only the pages of the columns that are used get read
+            with pa.memory_map(shard_path, "r") as f:
+                df = pa.ipc.open_file(f).read_all()
+        else:
+            with fs.open(shard_path, "rb") as f:
+                df = pa.ipc.open_file(f).read_all()
         schema = df.schema
         schema = (
             schema.append(pa.field("key", pa.string()))
@@ -336,14 +688,14 @@ class Downloader:
         if self.compute_hash is not None and self.compute_hash not in schema.names:
             schema = schema.append(pa.field(self.compute_hash, pa.string()))
 
-        pydict = df.select(self.column_list).to_pydict()
-        shard_to_dl = list(enumerate(zip(*(pydict[col] for col in self.column_list))))
-        del pydict
+        # keep the shard column wise, a sample is only assembled when its download completes
+        shard_columns = [df[col].to_pylist() for col in self.column_list]
+        count = df.num_rows
         del df
 
         status_dict = CappedCounter()
+        status_successes = 0
 
-        count = len(shard_to_dl)
         successes = 0
         failed_to_download = 0
         failed_to_resize = 0
@@ -354,14 +706,23 @@ class Downloader:
             self.column_list.index(self.verify_hash_type) if self.verify_hash_type in self.column_list else None
         )
         bbox_indice = self.column_list.index(self.blurring_bbox_col) if self.blurring_bbox_col is not None else None
-        key_url_list = [(key, x[url_indice]) for key, x in shard_to_dl]
+        if hash_indice is not None:
+            # the hash column is not saved in the metadata, it is only compared with the raw digests
+            shard_columns[hash_indice] = [decode_hex_digest(h) for h in shard_columns[hash_indice]]
+
+        # resolve the hosts of the shard in the background, the first download from each host then skips the dns
+        # round trip instead of waiting for it
+        dns_prewarm = Thread(target=prewarm_dns, args=(shard_columns[url_indice],), daemon=True)
+        dns_prewarm.start()
 
         # this prevents an accumulation of more than twice the number of threads in sample ready to resize
         # limit the memory usage
-        semaphore = Semaphore(self.thread_count * 2)
+        # the number of in flight samples is then adapted between thread_count and 4 * thread_count
+        semaphore = ResizableSemaphore(self.thread_count * 2)
+        concurrency_controller = ConcurrencyController(semaphore, self.thread_count, self.thread_count * 4)
 
         def data_generator():
-            for e in key_url_list:
+            for e in enumerate(shard_columns[url_indice]):
                 semaphore.acquire()  # pylint: disable=consider-using-with
                 yield e
 
@@ -377,52 +738,93 @@ class Downloader:
             self.encode_format,
         )
         oom_sample_per_shard = math.ceil(math.log10(self.number_sample_per_shard))
-        with ThreadPool(self.thread_count) as thread_pool:
-            try:
-                for (
-                    sample,
-                    error_message,
-                    step_successes,
-                    step_failed_to_download,
-                    step_failed_to_resize,
-                ) in thread_pool.imap_unordered(
-                    lambda x: download_and_process_image_with_retry(
-                        x,
-                        timeout=self.timeout,
-                        retries=self.retries,
-                        user_agent_token=self.user_agent_token,
-                        disallowed_header_directives=self.disallowed_header_directives,
-                        shard_id=shard_id,
-                        shard_to_dl=shard_to_dl,
-                        oom_sample_per_shard=oom_sample_per_shard,
-                        oom_shard_count=self.oom_shard_count,
-                        column_list=self.column_list,
-                        bbox_indice=bbox_indice,
-                        caption_indice=caption_indice,
-                        crop_indice=crop_indice,
-                        hash_indice=hash_indice,
-                        extract_exif=self.extract_exif,
-                        compute_hash=self.compute_hash,
-                        verify_hash_type=self.verify_hash_type,
-                        semaphore=semaphore,
-                        resizer=self.resizer,
-                    ),
-                    loader,
-                ):
-                    successes += step_successes
-                    failed_to_download += step_failed_to_download
-                    failed_to_resize += step_failed_to_resize
-    
-                    status_dict.increment(error_message if error_message is not None else "success")
+        # the pool can't be pickled to the worker processes, so it is created per shard
+        http_pool = ProxyAwarePoolManager(
+            num_pools=1024,
+            maxsize=concurrency_controller.max_value,
+            block=False,
+            headers={"User-Agent": get_user_agent_string(self.user_agent_token)},
+        )
+        hash_constructors = {}
+        if hash_indice is not None:
+            hash_constructors[self.verify_hash_type] = get_hash_constructor(self.verify_hash_type)
+        if self.compute_hash is not None:
+            hash_constructors[self.compute_hash] = get_hash_constructor(self.compute_hash)
+        meta_indices = [i for i in range(len(self.column_list)) if i != hash_indice]
+        cfg = WorkerConfig(
+            timeout=self.timeout,
+            retries=self.retries,
+            user_agent_token=self.user_agent_token,
+            disallowed_header_directives=self.disallowed_header_directives,
+            shard_columns=shard_columns,
+            key_offset=(10**oom_sample_per_shard) * shard_id,
+            key_width=oom_sample_per_shard + self.oom_shard_count,
+            meta_columns=[self.column_list[i] for i in meta_indices],
+            meta_indices=meta_indices,
+            bbox_indice=bbox_indice,
+            caption_indice=caption_indice,
+            crop_indice=crop_indice,
+            hash_indice=hash_indice,
+            extract_exif=self.extract_exif,
+            compute_hash=self.compute_hash,
+            verify_hash_type=self.verify_hash_type,
+            hash_constructors=hash_constructors,
+            semaphore=semaphore,
+            resizer=self.resizer,
+            http_pool=http_pool,
+        )
+        download_worker = functools.partial(download_and_hash_image, cfg=cfg)
+        process_worker = functools.partial(process_image, cfg=cfg)
+        # the writers which buffer samples column wise expose the batch size they prefer to get them in
+        write_batch_size = getattr(sample_writer, "write_batch_size", None)
+        pending_samples = []
+        # the download pool is sized for the maximum concurrency, the semaphore gates the real one
+        # decoding and resizing go to a pool sized for this process share of the cores, opencv releases the gil so
+        # these threads run in parallel without competing with hundreds of download threads
+        with http_pool, ThreadPool(concurrency_controller.max_value) as download_pool, ThreadPool(
+            get_processing_thread_count(self.processes_count)
+        ) as process_pool:
+            for (
+                sample,
+                error_message,
+                step_successes,
+                step_failed_to_download,
+                step_failed_to_resize,
+            ) in process_pool.imap_unordered(
+                process_worker,
+                download_pool.imap_unordered(download_worker, loader),
+            ):
+                successes += step_successes
+                failed_to_download += step_failed_to_download
+                failed_to_resize += step_failed_to_resize
+
+                # successes are the common case, they are counted in the status dict once at the end
+                if error_message is None:
+                    status_successes += 1
+                else:
+                    status_dict.increment(error_message)
+                concurrency_controller.record(error_message)
+                if sample is None:
+                    continue
+                if write_batch_size is None:
                     sample_writer.write(*sample)
-            except Exception  as exc:
-                traceback.print_exc()
-                print(f'XXXehsan error: {exc}')
-
+                    continue
+                pending_samples.append(sample)
+                if len(pending_samples) >= write_batch_size:
+                    sample_writer.write_batch(pending_samples)
+                    pending_samples.clear()
+
+            if status_successes:
+                status_dict.increment("success", status_successes)
+            if pending_samples:
+                sample_writer.write_batch(pending_samples)
             sample_writer.close()
-            thread_pool.terminate()
-            thread_pool.join()
-            del thread_pool
+            process_pool.terminate()
+            process_pool.join()
+            download_pool.terminate()
+            download_pool.join()
+            del process_pool
+            del download_pool
 
         end_time = time.time()
         write_stats(
@@ -437,4 +839,8 @@ class Downloader:
             status_dict,
             self.oom_shard_count,
         )
-        fs.rm(shard_path)
+        # the prewarm is normally done long before the downloads, joining it keeps a single one alive per process
+        dns_prewarm.join()
+        # the removal of the previous shard overlapped the download of this one, it's normally done by now
+        wait_for_shard_removals()
+        pending_shard_removals.append(shard_removal_executor.submit(remove_shard_file, fs, shard_path))
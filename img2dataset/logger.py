@@ -17,10 +17,10 @@ class CappedCounter:
         self.max_size = max_size
         self.counter = Counter()
 
-    def increment(self, key):
+    def increment(self, key, count=1):
         if len(self.counter) >= self.max_size:
             self._keep_most_frequent()
-        self.counter[key] += 1
+        self.counter[key] += count
 
     def _keep_most_frequent(self):
         self.counter = Counter(dict(self.counter.most_common(int(self.max_size / 2))))
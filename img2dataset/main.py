@@ -15,7 +15,7 @@ from .writer import (
     DummySampleWriter,
 )
 from .reader import Reader
-from .downloader import Downloader
+from .downloader import Downloader, get_hash_constructor, wait_for_shard_removals
 from .distributor import (
     single_process_distributor,
     multiprocessing_distributor,
@@ -36,9 +36,12 @@ logging.getLogger("exifread").setLevel(level=logging.CRITICAL)
 
 def arguments_validator(params):
     """Validate the arguments"""
-    if params["compute_hash"] not in [None, "md5", "sha256", "sha512"]:
+    if params["compute_hash"] not in [None, "md5", "sha256", "sha512", "blake3", "xxh3_128"]:
         hash_type = params["compute_hash"]
         raise ValueError(f"Unsupported hash to compute: {hash_type}")
+    if params["compute_hash"] is not None:
+        # the optional hash libraries are checked once here instead of failing every sample in the workers
+        get_hash_constructor(params["compute_hash"])
 
     if params["verify_hash"] is not None:
         _, verify_hash_type = params["verify_hash"]
@@ -66,6 +69,8 @@ def arguments_validator(params):
                 "md5",
                 "sha256",
                 "sha512",
+                "blake3",
+                "xxh3_128",
             ]
         )
         intersection = save_additional_columns_set.intersection(forbidden_columns)
@@ -144,14 +149,15 @@ def download(
     
     temp_download_folder = make_path_absolute(temp_download_folder)
 
-    fs, tmp_dir = fsspec.core.url_to_fs(temp_download_folder)
+    tmp_fs, tmp_dir = fsspec.core.url_to_fs(temp_download_folder)
  
-    if not fs.exists(tmp_dir):
-        fs.mkdir(tmp_dir)
+    created_tmp_dir = not tmp_fs.exists(tmp_dir)
+    if created_tmp_dir:
+        tmp_fs.mkdir(tmp_dir)
 
     def signal_handler(signal_arg, frame):  # pylint: disable=unused-argument
         try:
-            fs.rm(tmp_dir, recursive=True)
+            tmp_fs.rm(tmp_dir, recursive=True)
         except Exception as _:  # pylint: disable=broad-except
             pass
         logger_process.terminate()
@@ -262,6 +268,7 @@ def download(
         user_agent_token=user_agent_token,
         disallowed_header_directives=disallowed_header_directives,
         blurring_bbox_col=bbox_col,
+        processes_count=processes_count,
     )
 
     print("Starting the downloading of this file")
@@ -285,8 +292,20 @@ def download(
     )
     logger_process.join()
 
-    if not hasattr(fs, "s3"):
-        fs.rmdir(tmp_dir)
+    # the shard files are removed in the background, the worker processes may be terminated before removing theirs
+    wait_for_shard_removals()
+    if created_tmp_dir:
+        try:
+            tmp_fs.rm(tmp_dir, recursive=True)
+        except FileNotFoundError:
+            pass
+    else:
+        # a folder given by the user may contain other files, only the shard files of the reader are removed
+        for shard_file in reader.shard_files:
+            try:
+                tmp_fs.rm(shard_file)
+            except FileNotFoundError:
+                pass
 
 
 def main():
@@ -59,6 +59,8 @@ class Reader:
         fs, url_path = fsspec.core.url_to_fs(url_list)
         self.fs = fs
         self.tmp_path = tmp_path
+        # every shard file written to tmp_path, including the ones of the other partitions
+        self.shard_files = []
 
         if fs.isdir(url_path):
             self.input_files = sorted(fs.glob(url_path + "/*." + input_format))
@@ -206,6 +208,7 @@ class Reader:
             print("Sharding file number " + str(i + 1) + " of " + str(len(self.input_files)) + " called " + input_file)
 
             shards, number_shards = self._save_to_arrow(input_file, start_shard_id)
+            self.shard_files.extend(arrow_file for _, arrow_file in shards)
 
             if self.partition_index is not None and self.partition_count is not None:
                 shards = shards[self.partition_index :: self.partition_count]
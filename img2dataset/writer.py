@@ -36,6 +36,19 @@ class BufferedParquetWriter:
             self.flush()
         self._add_sample_to_buffer(sample)
 
+    def write_batch(self, samples):
+        """Add a list of samples to the buffer column by column, flushing every buffer_size samples"""
+        start = 0
+        while start < len(samples):
+            if self.current_buffer_size >= self.buffer_size:
+                self.flush()
+            end = start + self.buffer_size - self.current_buffer_size
+            chunk = samples[start:end]
+            for k in self.schema.names:
+                self.buffer[k].extend(sample[k] for sample in chunk)
+            self.current_buffer_size += len(chunk)
+            start = end
+
     def flush(self):
         """Write the buffer to disk"""
         if self.current_buffer_size == 0:
@@ -74,9 +87,11 @@ class ParquetSampleWriter:
         output_file = f"{output_folder}/{shard_name}.parquet"
         self.buffered_parquet_writer = BufferedParquetWriter(output_file, schema, 100)
         self.save_caption = save_caption
+        # the samples are buffered column wise, so the downloader hands them over one row group at a time
+        self.write_batch_size = self.buffered_parquet_writer.buffer_size
 
-    def write(self, img_str, key, caption, meta):
-        """Keep sample in memory then write to disk when close() is called"""
+    def _make_sample(self, img_str, key, caption, meta):
+        """Build the parquet row of a sample"""
         if img_str is not None:
             sample = {"key": key, self.encode_format: img_str}
             if self.save_caption:
@@ -86,7 +101,15 @@ class ParquetSampleWriter:
             if self.save_caption:
                 sample["txt"] = None
         sample.update(meta)
-        self.buffered_parquet_writer.write(sample)
+        return sample
+
+    def write(self, img_str, key, caption, meta):
+        """Keep sample in memory then write to disk when close() is called"""
+        self.buffered_parquet_writer.write(self._make_sample(img_str, key, caption, meta))
+
+    def write_batch(self, samples):
+        """Keep a list of (img_str, key, caption, meta) samples in memory"""
+        self.buffered_parquet_writer.write_batch([self._make_sample(*sample) for sample in samples])
 
     def close(self):
         self.buffered_parquet_writer.close()
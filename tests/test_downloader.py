@@ -1,10 +1,34 @@
 import shutil
 import pytest
 import json
+import hashlib
+import email.utils
+import time
+import functools
+import socket
+import ssl
+import subprocess
+import threading
+import http.server
+import urllib3
+from urllib3._collections import HTTPHeaderDict
 from fixtures import setup_fixtures
 from img2dataset.resizer import Resizer
 from img2dataset.writer import FilesSampleWriter
-from img2dataset.downloader import Downloader
+from img2dataset.downloader import (
+    Downloader,
+    ResizableSemaphore,
+    ConcurrencyController,
+    DnsCacheHTTPConnection,
+    ProxyAwarePoolManager,
+    compute_hashes,
+    get_hash_constructor,
+    download_image,
+    download_and_hash_image,
+    dns_cache,
+    is_disallowed,
+    parse_retry_after,
+)
 
 import os
 import pandas as pd
@@ -150,3 +174,149 @@ def test_downloader(tmp_path):
     downloader((0, tmp_file))
 
     assert len(os.listdir(image_folder_name + "/00000")) == 3 * n_allowed
+
+
+def test_concurrency_controller():
+    semaphore = ResizableSemaphore(8)
+    controller = ConcurrencyController(semaphore, min_value=4, max_value=16, window=10, step=2)
+
+    for _ in range(10):
+        controller.record(None)
+    assert semaphore.value_max == 10
+
+    for _ in range(10):
+        controller.record("HTTP Error 429: Too Many Requests")
+    assert semaphore.value_max == 5
+
+    # timeouts at the same rate as the previous window come from dead hosts, they don't shrink the capacity
+    controller = ConcurrencyController(ResizableSemaphore(8), min_value=4, max_value=16, window=10, step=2)
+    for _ in range(10):
+        controller.record("The read operation timed out")
+    assert controller.semaphore.value_max == 10
+
+    # a burst of timeouts compared with the previous window is throttling
+    controller = ConcurrencyController(ResizableSemaphore(8), min_value=4, max_value=16, window=10, step=2)
+    for _ in range(10):
+        controller.record(None)
+    assert controller.semaphore.value_max == 10
+    for _ in range(10):
+        controller.record("The read operation timed out")
+    assert controller.semaphore.value_max == 5
+
+
+def test_compute_hashes():
+    data = os.urandom(200 * 1024 + 3)
+    hashes = compute_hashes(data, {"md5": hashlib.md5, "sha256": hashlib.sha256})
+    assert hashes == {"md5": hashlib.md5(data).digest(), "sha256": hashlib.sha256(data).digest()}
+
+
+@pytest.mark.parametrize("compute_hash", ["blake3", "xxh3_128"])
+def test_compute_fast_hashes(compute_hash):
+    data = os.urandom(200 * 1024 + 3)
+    hashes = compute_hashes(data, {compute_hash: get_hash_constructor(compute_hash)})
+    if compute_hash == "blake3":
+        import blake3
+
+        assert hashes[compute_hash] == blake3.blake3(data).digest()
+    else:
+        import xxhash
+
+        assert hashes[compute_hash] == xxhash.xxh3_128(data).digest()
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("-3") == 0
+    assert parse_retry_after("not a delay") is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    future = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 50 < parse_retry_after(future) <= 60
+
+
+def test_is_disallowed():
+    disallowed = frozenset(["noai", "noindex"])
+
+    def headers(*values):
+        h = HTTPHeaderDict()
+        for value in values:
+            h.add("X-Robots-Tag", value)
+        return h
+
+    assert not is_disallowed(headers(), "img2dataset", disallowed)
+    assert not is_disallowed(headers("nofollow, noarchive"), "img2dataset", disallowed)
+    assert is_disallowed(headers("nofollow, NoAI"), "img2dataset", disallowed)
+    assert is_disallowed(headers("img2dataset: noindex"), "img2dataset", disallowed)
+    assert not is_disallowed(headers("otherbot: noindex"), "img2dataset", disallowed)
+    assert is_disallowed(headers("otherbot: noindex", "noai"), "img2dataset", disallowed)
+
+
+def test_proxy_aware_pool_manager(monkeypatch):
+    for name in ["http_proxy", "https_proxy", "no_proxy", "HTTP_PROXY", "HTTPS_PROXY", "NO_PROXY"]:
+        monkeypatch.delenv(name, raising=False)
+    assert ProxyAwarePoolManager().proxies == {}
+
+    monkeypatch.setenv("http_proxy", "proxy.example.com:3128")
+    http_pool = ProxyAwarePoolManager()
+    assert list(http_pool.proxies) == ["http"]
+    assert isinstance(http_pool.proxies["http"], urllib3.ProxyManager)
+    assert http_pool.proxies["http"].proxy.host == "proxy.example.com"
+    assert http_pool.proxies["http"].proxy.port == 3128
+
+
+def test_dns_cache_connection(monkeypatch):
+    host = "img2dataset-test.invalid"
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = server.getsockname()[1]
+        monkeypatch.setitem(dns_cache, host, "127.0.0.1")
+
+        # the unresolvable host is reached through its cached address
+        conn = DnsCacheHTTPConnection(host, port, timeout=5)
+        conn.connect()
+        assert conn.host == host
+        conn.close()
+
+    # a refused cached address is dropped and the host is resolved again
+    with pytest.raises(urllib3.exceptions.NewConnectionError):
+        DnsCacheHTTPConnection(host, port, timeout=5).connect()
+    assert host not in dns_cache
+
+
+def test_download_and_hash_image_error():
+    # a missing worker config makes the download stage raise, the error is returned for the processing stage
+    key, img_bytes, hashes, error_message = download_and_hash_image((3, "http://localhost/image.jpg"), None)
+    assert (key, img_bytes, hashes) == (3, None, {})
+    assert error_message.startswith("failed to process sample: ")
+
+
+def test_download_image_self_signed_https(tmp_path):
+    cert_file = str(tmp_path / "cert.pem")
+    key_file = str(tmp_path / "key.pem")
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost"]
+            + ["-keyout", key_file, "-out", cert_file],
+            check=True,
+            capture_output=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("openssl is needed to generate a self signed certificate")
+    (tmp_path / "image.jpg").write_bytes(b"image bytes")
+
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(tmp_path))
+    server = http.server.HTTPServer(("127.0.0.1", 0), handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"https://localhost:{server.server_address[1]}/image.jpg"
+        with ProxyAwarePoolManager() as http_pool:
+            key, img_bytes, err, status, _ = download_image((0, url), 5, None, None, http_pool)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert (key, img_bytes, err, status) == (0, b"image bytes", None, 200)
@@ -1,5 +1,6 @@
 from img2dataset import download
 import os
+import sys
 import shutil
 import pytest
 import glob
@@ -492,3 +493,33 @@ def test_verify_hash(tmp_path):
     df = pd.read_parquet(os.path.join(output_folder, "00000.parquet"))
 
     assert df["sha256"].isna().to_numpy().sum() == 1
+
+
+def test_missing_hash_library(monkeypatch, tmp_path):
+    # a None entry in sys.modules makes the import fail
+    monkeypatch.setitem(sys.modules, "blake3", None)
+    with pytest.raises(ModuleNotFoundError):
+        download(str(tmp_path / "urls.txt"), output_folder=str(tmp_path / "images"), compute_hash="blake3")
+    assert not os.path.exists(tmp_path / "images")
+
+
+def test_existing_temp_download_folder(tmp_path):
+    test_list = setup_fixtures()
+    url_list_name = generate_input_file("txt", str(tmp_path / "url_list"), test_list)
+    temp_download_folder = tmp_path / "scratch"
+    temp_download_folder.mkdir()
+    (temp_download_folder / "user_file.txt").write_text("keep me")
+
+    download(
+        url_list_name,
+        output_folder=str(tmp_path / "images"),
+        temp_download_folder=str(temp_download_folder),
+        thread_count=32,
+    )
+
+    # only the shard files are removed from a temp folder which existed before
+    assert os.listdir(temp_download_folder) == ["user_file.txt"]
+
+    download(url_list_name, output_folder=str(tmp_path / "images_default_tmp"), thread_count=32)
+
+    assert not os.path.exists(tmp_path / "images_default_tmp" / "_tmp")
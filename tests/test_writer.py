@@ -12,6 +12,7 @@ import pytest
 import tarfile
 import pandas as pd
 import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 @pytest.mark.parametrize("writer_type", ["files", "webdataset", "parquet", "dummy", "tfrecord"])
@@ -125,3 +126,20 @@ def test_writer(writer_type, tmp_path):
         assert len(l) == 1
         if l[0] != output_folder + "/00000.tfrecord":
             raise Exception(l[0] + " is not 00000.tfrecord")
+
+
+def test_parquet_writer_batch(tmp_path):
+    output_folder = str(tmp_path)
+    schema = pa.schema([pa.field("key", pa.string()), pa.field("status", pa.string())])
+    writer = ParquetSampleWriter(0, output_folder, False, 5, schema, "jpg")
+
+    samples = [(b"img" + str(i).encode(), str(i), None, {"key": str(i), "status": "ok"}) for i in range(250)]
+    writer.write(*samples[0])
+    writer.write_batch(samples[1:])
+    writer.close()
+
+    parquet_file = pq.ParquetFile(output_folder + "/00000.parquet")
+    assert [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)] == [100, 100, 50]
+    df = parquet_file.read().to_pandas()
+    assert df["key"].tolist() == [str(i) for i in range(250)]
+    assert df["jpg"].iloc[249] == b"img249"